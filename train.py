@@ -1,49 +1,188 @@
 import torch
 from torch.utils.data.distributed import DistributedSampler
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 import torch.nn as nn
 import torch.optim as optim
 from torch.utils.tensorboard import SummaryWriter
 
 import torchvision
-import torchvision.transforms as transforms
+import torchvision.transforms.v2 as transforms
+from torchvision.io import ImageReadMode, decode_jpeg, read_file
 
 # from autoaugment import ImageNetPolicy
 
 import argparse
+import contextlib
+import functools
+import math
 import os
 import random
+import threading
 import numpy as np
 
+# Background thread writing the latest checkpoint to disk
+SAVE_THREAD = None
+
 def set_random_seeds(random_seed=0):
 
     torch.manual_seed(random_seed)
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
     np.random.seed(random_seed)
     random.seed(random_seed)
 
-def evaluate(model, device, test_loader, epoch, criterion, writer):
+def make_ffcv_loader(beton_path, batch_size, num_workers, device, train):
+
+    # FFCV is only needed when training from the .beton files written by write_ffcv.py
+    from ffcv.fields.decoders import CenterCropRGBImageDecoder, IntDecoder, RandomResizedCropRGBImageDecoder
+    from ffcv.loader import Loader, OrderOption
+    from ffcv.transforms import RandomHorizontalFlip, Squeeze, ToDevice, ToTensor, ToTorchImage
+
+    if train:
+        image_pipeline = [RandomResizedCropRGBImageDecoder((224, 224)), RandomHorizontalFlip()]
+    else:
+        image_pipeline = [CenterCropRGBImageDecoder((224, 224), ratio=224 / 255)]
+    # Images stay uint8 until the GPU transforms, same as with the torchvision loaders
+    image_pipeline += [ToTensor(), ToDevice(device, non_blocking=True), ToTorchImage()]
+    label_pipeline = [IntDecoder(), ToTensor(), Squeeze(), ToDevice(device, non_blocking=True)]
+
+    return Loader(beton_path, batch_size=batch_size, num_workers=num_workers,
+                  order=OrderOption.RANDOM if train else OrderOption.SEQUENTIAL,
+                  drop_last=train, distributed=True,
+                  pipelines={"image": image_pipeline, "label": label_pipeline})
+
+def pin_worker_to_cores(worker_id, cores):
+
+    # Keep the data loading workers of this process on its own slice of the CPUs
+    os.sched_setaffinity(0, cores)
+
+def save_checkpoint(state_dict, filepath):
+
+    # Write to a temporary file first so an interrupted save never replaces the last good checkpoint
+    tmp_filepath = filepath + ".tmp"
+    torch.save(state_dict, tmp_filepath)
+    os.replace(tmp_filepath, filepath)
+
+def save_checkpoint_async(state_dict, filepath):
+
+    global SAVE_THREAD
+
+    # Only one checkpoint is written at a time
+    if SAVE_THREAD is not None:
+        SAVE_THREAD.join()
+
+    # Snapshot the weights on the CPU so training can keep updating the GPU copies
+    cpu_state_dict = {k: v.detach().to("cpu", non_blocking=True) for k, v in state_dict.items()}
+    torch.cuda.synchronize()
+    SAVE_THREAD = threading.Thread(target=save_checkpoint, args=(cpu_state_dict, filepath), daemon=True)
+    SAVE_THREAD.start()
+
+def set_performance_flags():
+
+    # Input shapes are fixed, so let cuDNN autotune the convolution algorithms once
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.deterministic = False
+    # Allow TF32 tensor cores on Ampere and newer
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
+def batch_random_rotation(images, degrees=30):
+
+    # Rotate every image by its own random angle, like RandomRotation does per sample on the CPU
+    angles = torch.empty(images.size(0), device=images.device).uniform_(-degrees, degrees) * math.pi / 180
+    cos, sin, zeros = angles.cos(), angles.sin(), torch.zeros_like(angles)
+    theta = torch.stack([torch.stack([cos, -sin, zeros], dim=1), torch.stack([sin, cos, zeros], dim=1)], dim=1)
+    grid = nn.functional.affine_grid(theta, list(images.shape), align_corners=False)
+    return nn.functional.grid_sample(images, grid, mode="nearest", padding_mode="zeros", align_corners=False)
+
+class Food101Tensor(torchvision.datasets.Food101):
+
+    # Decode JPEGs straight to uint8 tensors with libjpeg-turbo instead of going through PIL
+    def __getitem__(self, idx):
+
+        image = decode_jpeg(read_file(str(self._image_files[idx])), mode=ImageReadMode.RGB)
+        label = self._labels[idx]
+
+        if self.transform:
+            image = self.transform(image)
+        if self.target_transform:
+            label = self.target_transform(label)
+
+        return image, label
+
+class CUDAPrefetcher:
+
+    # Copies batch N+1 to the device on a side stream while batch N is being processed
+    def __init__(self, loader, device, transform=None, memory_format=torch.contiguous_format):
+
+        self.loader = iter(loader)
+        self.device = device
+        self.transform = transform
+        self.memory_format = memory_format
+        self.stream = torch.cuda.Stream(device=device)
+        self.preload()
+
+    def preload(self):
+
+        try:
+            inputs, labels = next(self.loader)
+        except StopIteration:
+            self.next_inputs = None
+            self.next_labels = None
+            return
+
+        # Loaders that already return GPU tensors (FFCV) only order their copies against the compute stream
+        compute_stream = torch.cuda.current_stream(self.device)
+        with torch.cuda.stream(self.stream):
+            if inputs.is_cuda:
+                self.stream.wait_stream(compute_stream)
+            self.next_inputs = inputs.to(self.device, non_blocking=True)
+            self.next_labels = labels.to(self.device, non_blocking=True)
+            if self.transform is not None:
+                self.next_inputs = self.transform(self.next_inputs)
+            # The GPU transforms allocate new NCHW tensors, so convert the layout once at the end
+            self.next_inputs = self.next_inputs.contiguous(memory_format=self.memory_format)
+
+    def next(self):
+
+        torch.cuda.current_stream(self.device).wait_stream(self.stream)
+        inputs, labels = self.next_inputs, self.next_labels
+        if inputs is None:
+            return None
+        # Tell the caching allocator these tensors are now used on the compute stream
+        inputs.record_stream(torch.cuda.current_stream(self.device))
+        labels.record_stream(torch.cuda.current_stream(self.device))
+        self.preload()
+        return inputs, labels
+
+def evaluate(model, device, test_loader, epoch, criterion, writer, transform=None):
 
     model.eval()
 
-    correct = 0
-    total = 0
-    avg_loss_test = 0
+    # Keep the running counts on the GPU so that there is a single device sync at the end
+    correct = torch.zeros((), device=device, dtype=torch.long)
+    total = torch.zeros((), device=device, dtype=torch.long)
+    avg_loss_test = torch.zeros((), device=device)
     with torch.no_grad():
-        for data in test_loader:
-            images, labels = data[0].to(device), data[1].to(device)
-            outputs = model(images)
-            _, predicted = torch.max(outputs.data, 1)
-            loss = criterion(outputs, labels)
+        prefetcher = CUDAPrefetcher(test_loader, device, transform=transform, memory_format=torch.channels_last)
+        while (batch := prefetcher.next()) is not None:
+            images, labels = batch
+            with torch.cuda.amp.autocast(dtype=torch.float16):
+                outputs = model(images)
+                loss = criterion(outputs, labels)
             total += labels.size(0)
-            correct += (predicted == labels).sum().item()
-            avg_loss_test += loss
+            correct += (outputs.argmax(dim=1) == labels).sum()
+            avg_loss_test += loss.detach()
 
-    avg_loss_test /= len(test_loader.sampler)
+    # Each rank only saw its shard of the test set, so sum the statistics over all ranks
+    stats = torch.stack([correct.double(), total.double(), avg_loss_test.double(),
+                         torch.tensor(len(test_loader), device=device, dtype=torch.float64)])
+    torch.distributed.all_reduce(stats)
+    correct, total, loss_sum, num_batches = stats.tolist()
+
+    # The criterion already averages over the batch, so normalize by the number of batches
+    avg_loss_test = loss_sum / num_batches
     accuracy = correct / total
 
-    if writer:
+    if writer is not None:
         writer.add_scalar("Loss/test", avg_loss_test, epoch)
         writer.add_scalar("Accuracy/test", accuracy, epoch)
 
@@ -54,6 +193,7 @@ def main():
     num_epochs_default = 250 #10000
     batch_size_default = 64 #128 #256 # 1024
     learning_rate_default = 0.1
+    accum_steps_default = 1
     random_seed_default = 0
     model_dir_default = "saved_models"
     model_filename_default = "resnet_distributed.pth"
@@ -64,18 +204,29 @@ def main():
     parser.add_argument("--num_epochs", type=int, help="Number of training epochs.", default=num_epochs_default)
     parser.add_argument("--batch_size", type=int, help="Training batch size for one process.", default=batch_size_default)
     parser.add_argument("--learning_rate", type=float, help="Learning rate.", default=learning_rate_default)
+    parser.add_argument("--accum_steps", type=int, help="Number of batches to accumulate gradients over before each optimizer step.", default=accum_steps_default)
     parser.add_argument("--random_seed", type=int, help="Random seed.", default=random_seed_default)
     parser.add_argument("--model_dir", type=str, help="Directory for saving models.", default=model_dir_default)
     parser.add_argument("--model_filename", type=str, help="Model filename.", default=model_filename_default)
     parser.add_argument("--resume", action="store_true", help="Resume training from saved checkpoint.")
     parser.add_argument("--score", type=str, default="None", help="What type of energy score to use")
     parser.add_argument("--eval", action="store_true", help="Run eval on the model")
+    parser.add_argument("--ffcv_dir", type=str, default=None, help="Directory with the food101_{train,test}.beton files written by write_ffcv.py. Uses the torchvision dataset if not set.")
+    parser.add_argument("--id_batch", type=int, default=None, help="Number of in-distribution samples at the start of each batch for the energy/OE losses. Defaults to half the batch.")
     argv = parser.parse_args()
+    if argv.accum_steps < 1:
+        parser.error("--accum_steps must be at least 1, got {}".format(argv.accum_steps))
+    # Both the in-distribution and the outlier part of each batch must be non-empty, otherwise the losses are NaN
+    if argv.id_batch is not None and not 0 < argv.id_batch < argv.batch_size:
+        parser.error("--id_batch must be between 1 and --batch_size - 1, got {}".format(argv.id_batch))
+    if argv.score in ("energy", "OE") and argv.batch_size < 2:
+        parser.error("--score {} needs a --batch_size of at least 2".format(argv.score))
 
     local_rank = argv.local_rank
     num_epochs = argv.num_epochs
     batch_size = argv.batch_size
     learning_rate = argv.learning_rate
+    accum_steps = argv.accum_steps
     random_seed = argv.random_seed
     model_dir = argv.model_dir
     model_filename = argv.model_filename
@@ -97,101 +248,185 @@ def main():
 
     # We need to use seeds to make sure that the models initialized in different processes are the same
     set_random_seeds(random_seed=random_seed)
+    set_performance_flags()
+
+    # Bind this process to its GPU before NCCL creates its communicators
+    torch.cuda.set_device(local_rank)
+    device = torch.device("cuda:{}".format(local_rank))
 
     # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
-    torch.distributed.init_process_group(backend="nccl")
+    torch.distributed.init_process_group(backend="nccl", init_method="env://")
     # torch.distributed.init_process_group(backend="gloo")
 
     # Encapsulate the model on the GPU assigned to the current process
     model = torchvision.models.resnet50(pretrained=False)
-    model.fc = nn.Sequential( nn.Linear(2048, 101))
+    model.fc = nn.Linear(2048, 101)
 
-    device = torch.device("cuda:{}".format(local_rank))
     model = model.to(device)
-    ddp_model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[local_rank], output_device=local_rank)
+    # NHWC lets cuDNN pick tensor core kernels without transposing every convolution input
+    model = model.to(memory_format=torch.channels_last)
+    # The .grad tensors are views into the all-reduce buckets, and the set of used parameters never changes between steps
+    ddp_model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[local_rank], output_device=local_rank,
+                                                          gradient_as_bucket_view=True, static_graph=True)
 
     # We only save the model who uses device "cuda:0"
     # To resume, the device for the saved model would also be "cuda:0"
     if resume == True:
         map_location = {"cuda:0": "cuda:{}".format(local_rank)}
-        ddp_model.load_state_dict(torch.load(model_filepath, map_location=map_location))
+        state_dict = torch.load(model_filepath, map_location=map_location)
+        # Older checkpoints wrapped the classifier in an nn.Sequential
+        state_dict = {k.replace("fc.0.", "fc."): v for k, v in state_dict.items()}
+        ddp_model.load_state_dict(state_dict)
+
+    # Fuse the eager kernels with Inductor; ddp_model is kept for state_dict and no_sync
+    # so that checkpoints keep their original keys
+    torch._dynamo.config.cache_size_limit = 64
+    compiled_model = torch.compile(ddp_model, mode="max-autotune", fullgraph=False)
 
     # Prepare dataset and dataloader
     # TODO: Define transforms for the training data and testing data
     # imagenet_stats = [(0.485, 0.456, 0.406), (0.229, 0.224, 0.225)]
-    train_transforms = transforms.Compose([transforms.RandomRotation(30),
-                                        transforms.RandomResizedCrop(224),
-                                        transforms.RandomHorizontalFlip(),
-                                        transforms.ToTensor(),
+    # The workers only decode and crop to uint8 tensors, the float ops run batched on the GPU
+    train_transforms = transforms.Compose([transforms.RandomResizedCrop(224, antialias=True),
+                                        transforms.RandomHorizontalFlip()])
+
+    test_transforms = transforms.Compose([transforms.Resize(255, antialias=True),
+                                        transforms.CenterCrop(224)])
+
+    train_gpu_transforms = transforms.Compose([transforms.ToDtype(torch.float32, scale=True),
+                                        transforms.Lambda(batch_random_rotation),
                                         transforms.Normalize([0.485, 0.456, 0.406],
                                                                 [0.229, 0.224, 0.225])])
 
-    test_transforms = transforms.Compose([transforms.Resize(255),
-                                        transforms.CenterCrop(224),
-                                        transforms.ToTensor(),
+    test_gpu_transforms = transforms.Compose([transforms.ToDtype(torch.float32, scale=True),
                                         transforms.Normalize([0.485, 0.456, 0.406],
                                                             [0.229, 0.224, 0.225])])
 
-    # Data should be prefetched
-    # Download should be set to be False, because it is not multiprocess safe
-    train_set = torchvision.datasets.Food101(root="/nobackup/food101", split='train', download=False, transform=train_transforms) 
-    test_set = torchvision.datasets.Food101(root="/nobackup/food101", split='test', download=False, transform=test_transforms)
-
-    # Restricts data loading to a subset of the dataset exclusive to the current process
-    train_sampler = DistributedSampler(dataset=train_set)
-
-    train_loader = DataLoader(dataset=train_set, batch_size=batch_size, sampler=train_sampler, num_workers=8)
-    # Test loader does not have to follow distributed sampling strategy
-    test_loader = DataLoader(dataset=test_set, batch_size=128, shuffle=False, num_workers=8)
+    # Split the CPUs of this node evenly between the processes running on it and leave one core per process for the main thread
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", os.environ.get("WORLD_SIZE", 1)))
+    available_cores = sorted(os.sched_getaffinity(0))
+    cores_per_rank = max(1, len(available_cores) // local_world_size)
+    rank_cores = available_cores[local_rank * cores_per_rank:(local_rank + 1) * cores_per_rank] or available_cores
+    num_workers = max(1, len(rank_cores) - 1)
+    # Evaluation only runs every 10 epochs, so its loader gets a few short-lived workers instead of a second full pool
+    test_num_workers = min(2, num_workers)
+    worker_init_fn = functools.partial(pin_worker_to_cores, cores=rank_cores)
+
+    if argv.ffcv_dir is not None:
+        # FFCV shards the data between processes itself and delivers uint8 batches already on the GPU
+        train_sampler = None
+        train_loader = make_ffcv_loader(os.path.join(argv.ffcv_dir, "food101_train.beton"), batch_size, num_workers, device, train=True)
+        test_loader = make_ffcv_loader(os.path.join(argv.ffcv_dir, "food101_test.beton"), 128, test_num_workers, device, train=False)
+    else:
+        # Data should be prefetched
+        # Download should be set to be False, because it is not multiprocess safe
+        train_set = Food101Tensor(root="/nobackup/food101", split='train', download=False, transform=train_transforms) 
+        test_set = Food101Tensor(root="/nobackup/food101", split='test', download=False, transform=test_transforms)
+
+        # Restricts data loading to a subset of the dataset exclusive to the current process
+        train_sampler = DistributedSampler(dataset=train_set)
+
+        # The energy/OE losses split every batch, so a short last batch could leave one side empty
+        drop_last = argv.score in ("energy", "OE")
+        train_loader = DataLoader(dataset=train_set, batch_size=batch_size, sampler=train_sampler, drop_last=drop_last, num_workers=num_workers, prefetch_factor=4, pin_memory=True, persistent_workers=True, worker_init_fn=worker_init_fn)
+        # Each process evaluates its own shard of the test set and the metrics are all-reduced
+        # Strided shards without DistributedSampler's padding, so every test image is counted exactly once
+        rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+        test_shard = Subset(test_set, range(rank, len(test_set), world_size))
+        test_loader = DataLoader(dataset=test_shard, batch_size=128, shuffle=False, num_workers=test_num_workers, pin_memory=True, persistent_workers=False, worker_init_fn=worker_init_fn)
 
     criterion = nn.CrossEntropyLoss()
     optimizer = optim.SGD(ddp_model.parameters(), lr=learning_rate, momentum=0.9, weight_decay=1e-5)
 
-    writer = SummaryWriter()
+    # Scales the loss so that float16 gradients do not underflow
+    scaler = torch.cuda.amp.GradScaler()
 
     if argv.eval:
-        accuracy = evaluate(model=ddp_model, device=device, test_loader=test_loader, epoch=0, criterion=criterion, writer=None)
-        print("Accuracy on test data: {}".format(accuracy))
+        accuracy = evaluate(model=compiled_model, device=device, test_loader=test_loader, epoch=0, criterion=criterion, writer=None, transform=test_gpu_transforms)
+        if local_rank == 0:
+            print("Accuracy on test data: {}".format(accuracy))
         exit()
 
+    # Only rank 0 logs to TensorBoard, and events are flushed to disk every two minutes
+    writer = SummaryWriter(flush_secs=120) if local_rank == 0 else None
+
     # Loop over the dataset multiple times
     for epoch in range(num_epochs):
 
+        # Reshuffle the shards every epoch, the FFCV loader does this on its own
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
+
         print("Local Rank: {}, Epoch: {}, Training ...".format(local_rank, epoch))
-        avg_loss_train = 0
+        loss_sum = torch.zeros((), device=device)
+        num_samples = 0
         
         # Save and evaluate model routinely
         if epoch % 10 == 0:
+            # Every process takes part in evaluation because the metrics are all-reduced
+            accuracy = evaluate(model=compiled_model, device=device, test_loader=test_loader, epoch=epoch, criterion=criterion, writer=writer, transform=test_gpu_transforms)
             if local_rank == 0:
-                accuracy = evaluate(model=ddp_model, device=device, test_loader=test_loader, epoch=epoch, criterion=criterion, writer=writer)
-                torch.save(ddp_model.state_dict(), model_filepath)
+                save_checkpoint_async(ddp_model.state_dict(), model_filepath)
                 print("-" * 75)
                 print("Epoch: {}, Accuracy: {}".format(epoch, accuracy))
                 print("-" * 75)
 
         ddp_model.train()
 
-        for data in train_loader:
-            inputs, labels = data[0].to(device), data[1].to(device)
-            optimizer.zero_grad()
-            outputs = ddp_model(inputs)
-            loss = criterion(outputs, labels)
-
-
-            # https://github.com/wetliu/energy_ood/blob/master/CIFAR/train.py
-            if argv.score == "energy":
-                Ec_out = -torch.logsumexp(outputs[len(inputs[0]):], dim=1)
-                Ec_in = -torch.logsumexp(outputs[:len(inputs[0])], dim=1)
-                loss += 0.1*(torch.pow(nn.functional.relu(Ec_in-(-25)), 2).mean() + torch.pow(nn.functional.relu((-7)-Ec_out), 2).mean())
-            elif argv.score == "OE":
-                loss += 0.5 * -(outputs[len(inputs[0]):].mean(1) - torch.logsumexp(outputs[len(inputs[0]):], dim=1)).mean()
-
-            avg_loss_train += loss
-            loss.backward()
-            optimizer.step()
-        avg_loss_train /= len(train_loader.sampler)
-        writer.add_scalar("Loss/train", avg_loss_train, epoch)
-    writer.close()
+        optimizer.zero_grad(set_to_none=True)
+        step_idx = 0
+        prefetcher = CUDAPrefetcher(train_loader, device, transform=train_gpu_transforms, memory_format=torch.channels_last)
+        while (batch := prefetcher.next()) is not None:
+            inputs, labels = batch
+            # Only all-reduce gradients on the last micro-batch of each accumulation window
+            sync_step = (step_idx + 1) % accum_steps == 0 or step_idx + 1 == len(train_loader)
+            # The last window of the epoch can be shorter, average over the batches it actually has
+            window_start = step_idx - step_idx % accum_steps
+            window_len = min(accum_steps, len(train_loader) - window_start)
+            # DDP decides whether to all-reduce during the forward pass, so it has to be inside no_sync() too
+            sync_ctx = contextlib.nullcontext() if sync_step else ddp_model.no_sync()
+            with sync_ctx:
+                with torch.cuda.amp.autocast(dtype=torch.float16):
+                    outputs = compiled_model(inputs)
+                    loss = criterion(outputs, labels)
+
+
+                    # https://github.com/wetliu/energy_ood/blob/master/CIFAR/train.py
+                    if argv.score in ("energy", "OE"):
+                        # The first id_batch samples are in-distribution, the rest are treated as outliers
+                        # (len(inputs[0]) was the channel count of the first image, not the split point)
+                        id_batch = argv.id_batch if argv.id_batch is not None else inputs.size(0) // 2
+                        # A single reduction over the logits, shared by both scores
+                        lse = torch.logsumexp(outputs, dim=1)
+                    if argv.score == "energy":
+                        Ec = -lse
+                        Ec_in = Ec[:id_batch]
+                        Ec_out = Ec[id_batch:]
+                        loss += 0.1*(torch.pow(nn.functional.relu(Ec_in-(-25)), 2).mean() + torch.pow(nn.functional.relu((-7)-Ec_out), 2).mean())
+                    elif argv.score == "OE":
+                        loss += 0.5 * -(outputs[id_batch:].mean(1) - lse[id_batch:]).mean()
+
+                # Detach so the autograd graph of every step is not kept alive until the end of the epoch
+                loss_sum += loss.detach() * labels.size(0)
+                num_samples += labels.size(0)
+                scaler.scale(loss / window_len).backward()
+            if sync_step:
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
+            step_idx += 1
+
+        # Average the loss over the samples of all processes with a single all-reduce
+        stats = torch.stack([loss_sum, torch.tensor(num_samples, device=device, dtype=loss_sum.dtype)])
+        torch.distributed.all_reduce(stats)
+        if writer is not None:
+            writer.add_scalar("Loss/train", (stats[0] / stats[1]).item(), epoch)
+
+    # Make sure the last checkpoint is fully written before exiting
+    if SAVE_THREAD is not None:
+        SAVE_THREAD.join()
+    if writer is not None:
+        writer.close()
 
 if __name__ == "__main__":
     
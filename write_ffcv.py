@@ -0,0 +1,35 @@
+from ffcv.writer import DatasetWriter
+from ffcv.fields import IntField, RGBImageField
+
+import torchvision
+
+import argparse
+import os
+
+def main():
+
+    data_root_default = "/nobackup/food101"
+    output_dir_default = "/nobackup/food101"
+    max_resolution_default = 256
+    jpeg_quality_default = 90
+
+    # One-time conversion of Food101 into the .beton files read by train.py --ffcv_dir
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--data_root", type=str, help="Directory containing the Food101 dataset.", default=data_root_default)
+    parser.add_argument("--output_dir", type=str, help="Directory for the .beton files.", default=output_dir_default)
+    parser.add_argument("--max_resolution", type=int, help="Images are resized so that their longer side is at most this many pixels.", default=max_resolution_default)
+    parser.add_argument("--jpeg_quality", type=int, help="JPEG quality of the re-encoded images.", default=jpeg_quality_default)
+    parser.add_argument("--num_workers", type=int, help="Number of writer processes.", default=os.cpu_count())
+    argv = parser.parse_args()
+
+    for split in ["train", "test"]:
+        dataset = torchvision.datasets.Food101(root=argv.data_root, split=split, download=False)
+        writer = DatasetWriter(os.path.join(argv.output_dir, "food101_{}.beton".format(split)), {
+            "image": RGBImageField(write_mode="jpg", max_resolution=argv.max_resolution, jpeg_quality=argv.jpeg_quality),
+            "label": IntField(),
+        }, num_workers=argv.num_workers)
+        writer.from_indexed_dataset(dataset)
+
+if __name__ == "__main__":
+
+    main()